@@ -0,0 +1,110 @@
+"""
+torch.utils.data pipeline for the frame identification datasets.
+
+Replaces torchtext's BucketIterator so batches can be assembled by worker
+processes while the model trains.
+"""
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, Sampler, DataLoader
+
+
+class FrameDataset(Dataset):
+    """
+    Map-style view over the examples of a torchtext TabularDataset.
+
+    Sentences are numericalized once up front, so the workers only have to
+    pad and stack them.
+    """
+
+    def __init__(self, examples, text_field, label_names):
+        stoi = text_field.vocab.stoi
+        prefix = [text_field.init_token] if text_field.init_token else []
+        suffix = [text_field.eos_token] if text_field.eos_token else []
+
+        self.texts = [torch.tensor([stoi[token] for token in prefix + ex.TEXT + suffix], dtype=torch.long)
+                      for ex in examples]
+        self.labels = np.array([[int(getattr(ex, name)) for name in label_names] for ex in examples],
+                               dtype=np.int8)
+        # cached once; BucketBatchSampler sorts on these every epoch
+        self.lengths = np.fromiter(map(len, self.texts), dtype=np.int64, count=len(self.texts))
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, idx):
+        return self.texts[idx], self.labels[idx]
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Groups examples of similar length into batches to keep padding low.
+
+    Mirrors BucketIterator: when shuffling, indices are shuffled, sorted by
+    length within pools of `pool_factor` batches and the resulting batches
+    are shuffled again. Otherwise the whole dataset is sorted by length.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, pool_factor=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_factor = pool_factor
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.permutation(len(self.lengths))
+            pool_size = self.batch_size * self.pool_factor
+        else:
+            indices = np.arange(len(self.lengths))
+            pool_size = len(indices)
+
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+
+        if self.shuffle:
+            np.random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class PadCollate(object):
+    """
+    Pads a list of (token_ids, labels) examples into a (seq_len, batch) input
+    tensor and stacks their labels into a (batch, no_of_classes) int8 tensor.
+    """
+
+    def __init__(self, pad_idx):
+        self.pad_idx = pad_idx
+
+    def __call__(self, batch):
+        texts, labels = zip(*batch)
+        inputs = pad_sequence(texts, padding_value=self.pad_idx)
+        targets = torch.from_numpy(np.stack(labels, axis=0))
+        return inputs, targets
+
+
+def make_loader(dataset, batch_size, pad_idx, train=True, num_workers=0):
+    """
+    Builds a bucketed DataLoader over a FrameDataset.
+
+    :param dataset: FrameDataset to draw examples from
+    :param batch_size: maximum number of examples per batch
+    :param pad_idx: vocabulary index of the padding token
+    :param train: shuffle the buckets every epoch
+    :param num_workers: number of worker processes assembling batches
+    :return: DataLoader yielding (inputs, targets) batches
+    """
+    return DataLoader(dataset,
+                      batch_sampler=BucketBatchSampler(dataset.lengths, batch_size, shuffle=train),
+                      collate_fn=PadCollate(pad_idx),
+                      num_workers=num_workers,
+                      pin_memory=True,
+                      prefetch_factor=2,
+                      persistent_workers=num_workers > 0)
@@ -7,17 +7,18 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim import lr_scheduler
-from utilities import get_free_gpu
+from utilities import get_free_gpu, PrefetchIter
 import numpy as np
-import models, visualize
+import models
+from loaders import FrameDataset, make_loader
 import time
+import math
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from torchtext.data import (
-    Iterator,
+from torchtext.legacy.data import (
     Field,
-    BucketIterator,
     TabularDataset
 )
 
@@ -37,6 +38,28 @@ device = torch.device("cuda:0")
 frame_classes = ["PERSON", "LOC", "ORG", "WORK_OF_ART", "PRODUCT", "EVENT", "OTHER"]
 no_of_classes = len(frame_classes)
 
+# sigmoid is monotonic, so sigmoid(x) > threshold <=> x > logit(threshold)
+threshold = 0.4
+logit_threshold = math.log(threshold / (1 - threshold))
+
+
+def predict(outputs):
+    """
+    Turns model logits into 0/1 frame predictions at the configured threshold.
+    """
+    return (outputs > logit_threshold).to(torch.int8)
+
+
+def micro_scores(true_pos, false_pos, false_neg):
+    """
+    Micro-averaged precision, recall and f1-score from global counts.
+    Like sklearn, a score whose denominator is zero is reported as 0.0.
+    """
+    precision = true_pos / (true_pos + false_pos) if true_pos + false_pos else 0.0
+    recall = true_pos / (true_pos + false_neg) if true_pos + false_neg else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
 
 def train_model(model, model_name, dataloaders, criterion, optimizer, scheduler, args, num_epochs=10):
     """
@@ -50,11 +73,22 @@ def train_model(model, model_name, dataloaders, criterion, optimizer, scheduler,
     """
     since = time.time()
 
-    best_model_wts = model.state_dict()
+    # state_dict() returns references to the live parameters, so keep a copy
+    best_model_wts = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
     best_acc = best_recall =  best_precision = best_f1 = 0.0
     dataset_sizes = {x: len(dataloaders[x].dataset) for x in ["train", "val"]}
     model_loss = {x: [0 for _ in range(num_epochs)] for x in ["train", "val"]}
 
+    # checkpoints are written on a background thread so disk I/O doesn't stall training
+    saver = ThreadPoolExecutor(max_workers=1)
+    checkpoints = []
+
+    # float copy of the int8 targets, reused by every batch for the loss
+    target_buf = torch.empty(args.batch_size, no_of_classes, dtype=torch.float32, device=device)
+
+    # scales the loss so float16 gradients don't underflow
+    scaler = torch.cuda.amp.GradScaler()
+
     for epoch in range(num_epochs):
         logging.info('Epoch {}/{}'.format(epoch + 1, num_epochs))
         logging.info('-' * 10)
@@ -66,52 +100,66 @@ def train_model(model, model_name, dataloaders, criterion, optimizer, scheduler,
             else:
                 model.eval()
 
-            running_loss = 0.0
+            # summed on the device so the loss isn't copied back every batch
+            running_loss = torch.zeros((), device=device)
             running_corrects = 0
 
-            y_true = np.empty(shape=(0, no_of_classes), dtype=int)
-            y_pred = np.empty(shape=(0, no_of_classes), dtype=int)
+            n_batches = len(dataloaders[phase])
+            n_samples = dataset_sizes[phase]
 
-            # iterate over data
-            for batch_idx, (inputs, labels) in enumerate(dataloaders[phase]):
+            # micro-averaged statistics, accumulated on the device
+            true_pos = torch.zeros((), dtype=torch.long, device=device)
+            false_pos = torch.zeros((), dtype=torch.long, device=device)
+            false_neg = torch.zeros((), dtype=torch.long, device=device)
+            exact_matches = torch.zeros((), dtype=torch.long, device=device)
 
-                targets = torch.stack(labels, dim=1)
+            # validation runs entirely in inference mode, set once for the whole phase
+            grad_mode = torch.enable_grad() if phase == 'train' else torch.inference_mode()
 
-                # zero the parameter gradients
-                optimizer.zero_grad()
+            # iterate over data
+            with grad_mode:
+                for batch_idx, (inputs, targets) in enumerate(dataloaders[phase]):
 
-                with torch.set_grad_enabled(phase == 'train'):
-                    outputs, pred = model(inputs)
+                    # zero the parameter gradients
+                    optimizer.zero_grad(set_to_none=True)
 
-                    ones = torch.ones(outputs.shape).to(device)
-                    zeros = torch.zeros(outputs.shape).to(device)
+                    batch_targets = target_buf[:targets.size(0)].copy_(targets)
 
+                    # mixed precision forward; autocast runs BCEWithLogitsLoss in float32
+                    with torch.cuda.amp.autocast(dtype=torch.float16):
+                        outputs = model(inputs)
+                        loss = criterion(outputs, batch_targets)
 
-                    predicted = torch.where(pred > 0.4, ones, zeros)
-                    loss = criterion(outputs, targets.float())
+                    predicted = predict(outputs)
 
                     # backward + optimize only if in training phase
                     if phase == 'train':
-                        loss.backward(retain_graph=True)
-                        optimizer.step()
-
-                y_true = np.append(y_true, targets.cpu().numpy(), axis=0)
-                y_pred = np.append(y_pred, predicted.cpu().numpy(), axis=0)
-
-                # aggregate statistics
-                running_loss += loss.item() * inputs.size(0)
-
-                if phase == 'train' and batch_idx % 50 == 0:
-                    logging.info('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
-                        (epoch + 1),
-                        (batch_idx + 1) * len(labels),
-                        dataset_sizes[phase],
-                        100. * (batch_idx + 1) / len(dataloaders[phase]),
-                        loss.item()))
-
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = accuracy_score(y_true, y_pred)
-            epoch_precision, epoch_recall, epoch_f1, _ = precision_recall_fscore_support(y_true, y_pred, average="micro")
+                        scaler.scale(loss).backward()
+                        scaler.step(optimizer)
+                        scaler.update()
+
+                    hits = predicted.bool()
+                    gold = targets.bool()
+                    true_pos += (hits & gold).sum()
+                    false_pos += (hits & ~gold).sum()
+                    false_neg += (~hits & gold).sum()
+                    exact_matches += (predicted == targets).all(dim=1).sum()
+
+                    # aggregate statistics
+                    running_loss += loss.detach() * inputs.size(0)
+
+                    if phase == 'train' and batch_idx % 50 == 0:
+                        logging.info('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
+                            (epoch + 1),
+                            (batch_idx + 1) * len(targets),
+                            n_samples,
+                            100. * (batch_idx + 1) / n_batches,
+                            loss.item()))
+
+            epoch_loss = (running_loss / n_samples).item()
+            epoch_acc = exact_matches.item() / n_samples
+            epoch_precision, epoch_recall, epoch_f1 = micro_scores(
+                true_pos.item(), false_pos.item(), false_neg.item())
 
             model_loss[phase][epoch] = epoch_loss
 
@@ -124,9 +172,12 @@ def train_model(model, model_name, dataloaders, criterion, optimizer, scheduler,
                 best_f1 = epoch_f1
                 best_precision = epoch_precision
                 best_recall = epoch_recall
-                best_model_wts = model.state_dict()
-                torch.save(best_model_wts, "./models/{}.pt".format(model_name))
+                best_model_wts = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+                checkpoints.append(saver.submit(torch.save, best_model_wts, "./models/{}.pt".format(model_name)))
 
+    saver.shutdown(wait=True)
+    for checkpoint in checkpoints:
+        checkpoint.result()  # re-raise any error from saving
 
     time_elapsed = time.time() - since
     logging.info('\nTraining completed in {:.0f}m {:.0f}s'.format(
@@ -144,21 +195,19 @@ def train_model(model, model_name, dataloaders, criterion, optimizer, scheduler,
 def test_model(model, test_loader):
     model.eval()
 
-    y_true = np.empty(shape=(0, no_of_classes), dtype=int)
-    y_pred = np.empty(shape=(0, no_of_classes), dtype=int)
+    y_true_chunks = []
+    y_pred_chunks = []
 
-    with torch.no_grad():
-        for (inputs, labels) in test_loader:
-            targets = torch.stack(labels, dim=1)
-            outputs, pred = model(inputs)
+    with torch.inference_mode():
+        for (inputs, targets) in test_loader:
+            outputs = model(inputs)
+            predicted = predict(outputs)
 
-            ones = torch.ones(outputs.shape).to(device)
-            zeros = torch.zeros(outputs.shape).to(device)
+            y_true_chunks.append(targets.cpu().numpy())
+            y_pred_chunks.append(predicted.cpu().numpy().astype(int))
 
-            predicted = torch.where(pred > 0.4, ones, zeros)
-
-            y_true = np.append(y_true, targets.cpu().numpy(), axis=0)
-            y_pred = np.append(y_pred, predicted.cpu().numpy(), axis=0)
+    y_true = np.concatenate(y_true_chunks, axis=0)
+    y_pred = np.concatenate(y_pred_chunks, axis=0)
 
     test_acc = accuracy_score(y_true, y_pred)
     test_precision, test_recall, test_f1, _ = precision_recall_fscore_support(y_true, y_pred, average="micro")
@@ -173,8 +222,15 @@ def test_model(model, test_loader):
 def main(args):
     np.warnings.filterwarnings('ignore')
 
+    # bucketed batches keep input shapes stable, so let cuDNN pick the fastest kernels
+    torch.backends.cudnn.benchmark = True
+    # allow TF32 tensor cores for the LSTM and linear layers on Ampere and newer GPUs
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     os.makedirs("./graphs", exist_ok=True)
     os.makedirs("./models", exist_ok=True)
+    os.makedirs("./cache", exist_ok=True)
 
     model_name = "BiLSTMNetwork" if not args.attention else "BiLSTM_AttentionNetwork"
 
@@ -191,7 +247,15 @@ def main(args):
         test='ontonotes_ner_test.csv', format='csv', skip_header=True,
         fields=fields)
 
-    TEXT.build_vocab(train, val, test, vectors="glove.6B.50d")
+    # the vocabulary only holds vectors for the corpus words, so caching it skips loading
+    # all of GloVe on later runs. Delete the cache file after changing the data.
+    vocab_cache = "./cache/vocab_glove.6B.50d.pt"
+    if os.path.exists(vocab_cache):
+        TEXT.vocab = torch.load(vocab_cache)
+    else:
+        TEXT.build_vocab(train, val, test, vectors="glove.6B.50d")
+        torch.save(TEXT.vocab, vocab_cache)
+    pad_idx = TEXT.vocab.stoi[TEXT.pad_token]
 
     model = models.BiLSTM(embedding_dim=50,
                           hidden_dim=args.hidden_size,
@@ -210,19 +274,21 @@ def main(args):
 
     if not args.test:
 
-        train_iter, val_iter = BucketIterator.splits(
-            (train, val),  # we pass in the datasets we want the iterator to draw data from
-            batch_sizes=(args.batch_size, args.batch_size),
-            device=device,  # if you want to use the GPU, specify the GPU number here
-            sort_key=lambda x: len(x.TEXT),
-            # the BucketIterator needs to be told what function it should use to group the data.
-            sort_within_batch=False,
-            repeat=False  # we pass repeat=False because we want to wrap this Iterator layer.
-        )
+        # batches are assembled on the CPU by the workers and copied to the GPU by PrefetchIter
+        train_iter = make_loader(FrameDataset(train.examples, TEXT, frame_classes),
+                                 batch_size=args.batch_size,
+                                 pad_idx=pad_idx,
+                                 train=True,
+                                 num_workers=args.workers)
+        val_iter = make_loader(FrameDataset(val.examples, TEXT, frame_classes),
+                               batch_size=args.batch_size,
+                               pad_idx=pad_idx,
+                               train=False,
+                               num_workers=args.workers)
 
         dataloaders = {
-            "train": train_iter,
-            "val": val_iter
+            "train": PrefetchIter(train_iter, device),
+            "val": PrefetchIter(val_iter, device)
         }
 
         logging.info('Training...')
@@ -237,23 +303,22 @@ def main(args):
                                         num_epochs=args.epochs
         )
 
+        # matplotlib is only needed for the training plots
+        import visualize
         visualize.plot_loss(model_loss, model_name)
 
     else:
 
         logging.info('Testing...')
 
-        test_iter = BucketIterator(
-            test,
-            batch_size=args.batch_size,
-            sort_key=lambda x: len(x.TEXT),
-            device=device,
-            train=False,
-            repeat=False
-        )
+        test_iter = make_loader(FrameDataset(test.examples, TEXT, frame_classes),
+                                batch_size=args.batch_size,
+                                pad_idx=pad_idx,
+                                train=False,
+                                num_workers=args.workers)
 
         model.load_state_dict(torch.load("./models/{}.pt".format(model_name)))
-        y_test, y_pred = test_model(model, test_iter)
+        y_test, y_pred = test_model(model, PrefetchIter(test_iter, device))
 
     logging.info('Completed Successfully!')
 
@@ -284,4 +349,6 @@ if __name__ == "__main__":
                         help='number of layers (default: 1)')
     parser.add_argument('--attention', action='store_true', default=False,
                         help='Should add attention be added.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() // 2, metavar='N',
+                        help='number of data loading workers (default: half the CPU cores)')
     main(parser.parse_args())
@@ -45,5 +45,5 @@ class BiLSTM(nn.Module):
         else:
             y = lstm_out[-1]
 
-        y = self.hidden2label(y)
-        return y, F.sigmoid(y)
+        # logits; apply a sigmoid for probabilities
+        return self.hidden2label(y)
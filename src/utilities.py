@@ -1,5 +1,8 @@
 import os
+import queue
+import threading
 import numpy as np
+import torch
 
 
 def get_free_gpu():
@@ -7,3 +10,80 @@ def get_free_gpu():
     memory_available = [int(x.split()[2]) for x in open('tmp', 'r').readlines()]
     print(memory_available)
     return np.argmax(memory_available)
+
+
+class PrefetchIter(object):
+    """
+    Wraps a batch iterator so that batches are assembled and copied to the
+    device on a background thread while the main thread runs the model.
+
+    Each batch is yielded as a tuple with every tensor (including tensors
+    nested in tuples or lists) already on the device.
+    """
+
+    _done = object()
+
+    def __init__(self, loader, device, queue_size=2):
+        self.loader = loader
+        self.device = device
+        self.queue_size = queue_size
+        # host-to-device copies run on their own stream so they overlap compute
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        if isinstance(batch, (tuple, list)):
+            return type(batch)(self._to_device(x) for x in batch)
+        if self.stream is None:
+            return batch.to(self.device)
+        return batch.pin_memory().to(self.device, non_blocking=True)
+
+    def _copy(self, batch):
+        if self.stream is None:
+            return self._to_device(batch)
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+    def _tensors(self, batch):
+        if isinstance(batch, (tuple, list)):
+            for x in batch:
+                yield from self._tensors(x)
+        else:
+            yield batch
+
+    def _produce(self, batches):
+        try:
+            for batch in self.loader:
+                batches.put(self._copy(tuple(batch)))
+        except Exception as e:
+            batches.put(e)
+        finally:
+            batches.put(self._done)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.queue_size)
+        producer = threading.Thread(target=self._produce, args=(batches,), daemon=True)
+        producer.start()
+
+        while True:
+            batch = batches.get()
+            if batch is self._done:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            if self.stream is not None:
+                compute_stream = torch.cuda.current_stream(self.device)
+                compute_stream.wait_stream(self.stream)
+                # the copies were allocated on the side stream; keep the memory
+                # from being reused until the compute stream is done with it
+                for tensor in self._tensors(batch):
+                    tensor.record_stream(compute_stream)
+            yield batch
+
+        producer.join()
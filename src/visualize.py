@@ -5,12 +5,13 @@ if os.environ.get('DISPLAY', '') == '':
 mpl.use('Agg')
 mpl.rcParams['agg.path.chunksize'] = 10000
 
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import numpy as np
 
 
 def plot_loss(model_loss, model_name):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+
     fig, ax = plt.subplots()
 
     train_loss = model_loss["train"]
@@ -35,8 +36,11 @@ def plot_loss(model_loss, model_name):
 
 
 def plot_histograms(class_names, spreads, type='Simple'):
+    import matplotlib.pyplot as plt
+
     no_of_classes = len(class_names)
-    class_accuracies = [spreads[i][i] / sum(spreads[i]) for i in range(no_of_classes)]
+    spreads = np.asarray(spreads)
+    class_accuracies = np.diag(spreads) / spreads.sum(axis=1)
 
     x = np.arange(no_of_classes)
 
@@ -49,13 +53,16 @@ def plot_histograms(class_names, spreads, type='Simple'):
     plt.ylabel('Accuracy')
     hfig.savefig('./graphs/NSynth_accuracy_hist_' + type + '.png', bbox_inches='tight')
 
-    # Plots of each class predictions
+    # Plots of each class predictions, redrawn on the same figure
     for i in range(no_of_classes):
-        hfig, az = plt.subplots()
-        plt.title('Prediction spread of class: ' + class_names[i])
-        plt.bar(x, height=spreads[i])
-        plt.xticks(x, class_names)
-        plt.xlabel('Classes')
-        plt.ylabel('# Predicted')
+        az.clear()
+        az.set_title('Prediction spread of class: ' + class_names[i])
+        az.bar(x, height=spreads[i])
+        az.set_xticks(x)
+        az.set_xticklabels(class_names)
+        az.set_xlabel('Classes')
+        az.set_ylabel('# Predicted')
         hfig.savefig('./graphs/NSynth_class_' + class_names[i] + '_accuracy_hist_' + type + '.png',
                      bbox_inches='tight')
+
+    plt.close(hfig)